@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 import smbus
-import struct
 import time
 
 bus = smbus.SMBus(1)  # I2C bus 1
@@ -9,12 +8,18 @@ ADDRESS = 0x36
 def PowerOnReset(bus):
     bus.write_word_data(ADDRESS, 0xfe, 0x0054)
 
-def readVoltage(bus):
-    read = bus.read_word_data(ADDRESS, 0x02)
-    swapped = struct.unpack("<H", struct.pack(">H", read))[0]
-    voltage = swapped * 1.25 / 1000 / 16
-    return voltage
+def readBattery(bus):
+    # VCELL (0x02) and SOC (0x04) are adjacent, so one block read covers both
+    raw = bus.read_i2c_block_data(ADDRESS, 0x02, 4)
+    vcell = (raw[0] << 8) | raw[1]
+    soc = (raw[2] << 8) | raw[3]
+    voltage = vcell * 1.25 / 1000 / 16
+    capacity = soc / 256
+    return voltage, min(capacity, 100)
 
 PowerOnReset(bus)
-print(f"Voltage: {readVoltage(bus):.1f}V")
+time.sleep(0.25)  # Let the gauge finish resetting before the first read
+voltage, capacity = readBattery(bus)
+print(f"Voltage: {voltage:.1f}V")
+print(f"Battery: {capacity:.0f}%")
 time.sleep(1)
\ No newline at end of file
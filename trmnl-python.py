@@ -3,16 +3,24 @@
 import os
 import sys
 import time
+import signal
 import json
+import hashlib
 import requests
+from requests.adapters import HTTPAdapter
+import numpy as np
 from io import BytesIO
-from PIL import Image
+from PIL import Image, ImageDraw, ImageFont, ImageOps
 import argparse
 import logging
-import tempfile
 
 try:
-    from waveshare_epd import epd2in13_V4
+    import smbus
+except ImportError:
+    smbus = None  # Only needed for --with-battery
+
+try:
+    from waveshare_epd import epd2in13_V4, epdconfig
 except ImportError:
     print("Error: Waveshare EPD library not found. Please ensure epd2in13_V4.py is available.")
     sys.exit(1)
@@ -23,6 +31,20 @@ BUILD_DATE = "unknown"
 
 CONFIG_DIR = os.path.expanduser("~/.trmnl")
 CONFIG_FILE = os.path.join(CONFIG_DIR, "config.json")
+STATE_FILE = os.path.join(CONFIG_DIR, "state.json")
+
+# What --oneshot runs carry over to the next run to skip unchanged updates
+PERSISTED_STATE = ("render", "image_url", "etag", "last_modified", "image_hash", "frame_hash", "next_update", "refresh_delay")
+ONESHOT_SLACK = 10  # Seconds of timer and startup jitter tolerated before refresh_rate is due
+
+THRESHOLD = 128  # Grayscale level below which a pixel is drawn black
+FULL_REFRESH_EVERY = 60  # Partial updates between full refreshes
+SPI_SPEED_HZ = 10000000  # The Waveshare driver opens SPI at 4 MHz
+BATTERY_ADDRESS = 0x36  # MAX17040 fuel gauge on the UPS-Lite
+
+# Reused across refreshes so the API and image host connections stay alive
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=2))
 
 def load_config():
     if os.path.exists(CONFIG_FILE):
@@ -37,6 +59,28 @@ def save_config(api_key):
     with open(CONFIG_FILE, 'w') as f:
         json.dump(config, f, indent=2)
 
+def load_state(render):
+    # render holds the flags that shape the frame; cached hashes and validators
+    # only say "nothing changed" if the frame would be drawn the same way
+    state = {"updates": 0, "render": render}
+    if os.path.exists(STATE_FILE):
+        try:
+            with open(STATE_FILE, 'r') as f:
+                saved = json.load(f)
+            if saved.get("render") == render:
+                state.update({key: saved[key] for key in PERSISTED_STATE if key in saved})
+            else:
+                logging.info("Display options changed, ignoring saved state")
+        except (OSError, json.JSONDecodeError) as e:
+            logging.warning(f"Ignoring unreadable state file: {e}")
+    return state
+
+def save_state(state):
+    os.makedirs(CONFIG_DIR, exist_ok=True)
+    saved = {key: state[key] for key in PERSISTED_STATE if key in state}
+    with open(STATE_FILE, 'w') as f:
+        json.dump(saved, f, indent=2)
+
 def get_api_key():
     api_key = load_config()
     if not api_key:
@@ -45,13 +89,17 @@ def get_api_key():
     logging.debug(f"Loaded API key: {api_key}")
     return api_key
 
-def init_display():
+def set_spi_speed():
+    # epd.init() reopens the SPI device at the driver default, so reapply after each init
+    epdconfig.SPI.max_speed_hz = SPI_SPEED_HZ
+
+def init_display(epd, state):
     try:
-        epd = epd2in13_V4.EPD()
         epd.init()
+        set_spi_speed()
+        state["panel_mode"] = "full"
 #         logging.info("Waveshare 7.5\" e-ink display (V2) initialized successfully")
         logging.info("Waveshare 2.13\" e-ink display (V4) initialized successfully")
-        return epd
     except Exception as e:
         logging.error(f"Error initializing e-ink display: {e}")
         sys.exit(1)
@@ -63,24 +111,126 @@ def clear_display(epd):
 def test_display(epd):
     logging.info("Testing display with pattern...")
     width, height = epd.width, epd.height
-    buffer = bytearray(width * height + 7 // 8)
-    for i in range(len(buffer) // 2):
-        buffer[i] = 0x00  # Black
-    for i in range(len(buffer) // 2, len(buffer)):
-        buffer[i] = 0xFF  # White
+    size = (width + 7) // 8 * height
+    half = size // 2
+    buffer = bytearray(b'\x00' * half + b'\xFF' * (size - half))  # Black, then white
     epd.display(buffer)
-    time.sleep(2)
 
-def process_image(epd, api_key, dark_mode, verbose):
+def init_battery():
+    if smbus is None:
+        logging.error("Error: smbus not found. Install python3-smbus to use --with-battery.")
+        sys.exit(1)
+    # No power-on reset: VCELL and SOC read fine without one, and resetting on
+    # every start (each --oneshot run) would restart the gauge's SOC tracking
+    bus = smbus.SMBus(1)  # I2C bus 1
+    return {"bus": bus, "font": ImageFont.load_default()}
+
+def read_battery(bus):
+    # VCELL (0x02) and SOC (0x04) are adjacent, so one block read covers both
+    raw = bus.read_i2c_block_data(BATTERY_ADDRESS, 0x02, 4)
+    voltage = ((raw[0] << 8) | raw[1]) * 1.25 / 1000 / 16
+    capacity = ((raw[2] << 8) | raw[3]) / 256
+    return voltage, min(capacity, 100)
+
+def draw_battery(img, battery):
+    try:
+        voltage, capacity = read_battery(battery["bus"])
+    except OSError as e:
+        # A flaky gauge shouldn't cost the TRMNL frame; show it without the readout
+        logging.warning(f"Error reading battery: {e}")
+        return img
+    text = f"{voltage:.1f}V {capacity:.0f}%"
+    img = img.copy()
+    draw = ImageDraw.Draw(img)
+    left, top, right, bottom = draw.textbbox((0, 0), text, font=battery["font"])
+    x = img.width - (right - left) - 2
+    draw.rectangle((x - 2, 0, img.width - 1, bottom - top + 3), fill=255)
+    draw.text((x - left, 2 - top), text, font=battery["font"], fill=0)
+    return img
+
+# SWAR constants for eight 8-bit pixels held in one little-endian uint64;
+# the lane compare below is valid for 1 <= THRESHOLD <= 128
+LANE_HIGH_BITS = np.uint64(0x8080808080808080)
+LANE_THRESHOLD = np.uint64(THRESHOLD * 0x0101010101010101)
+LANE_GATHER = np.uint64(0x8040201008040201)
+
+def swar_threshold_pack(words, dark_mode, tail_mask, out):
+    # Each word is eight pixels, so one load and a few ALU ops per output byte
+    height, stride = words.shape
+    for y in range(height):
+        for xb in range(stride):
+            u = words[y, xb]
+            # Lane high bit set where pixel >= THRESHOLD, without cross-lane borrows
+            ge = (((u | LANE_HIGH_BITS) - LANE_THRESHOLD) | u) & LANE_HIGH_BITS
+            # Multiply gathers the eight lane bits into the top byte, first pixel in the MSB
+            b = ((ge >> np.uint64(7)) * LANE_GATHER) >> np.uint64(56)
+            if dark_mode:
+                b = ~b
+            out[y * stride + xb] = b & 0xFF
+        out[y * stride + stride - 1] &= tail_mask
+
+threshold_pack_kernel = None  # JIT-compiled swar_threshold_pack, set by enable_numba()
+
+def enable_numba():
+    # Opt-in: importing numba costs seconds and tens of MB on a Pi Zero, far more
+    # than it saves over np.packbits on a single small frame
+    global threshold_pack_kernel
+    try:
+        from numba import njit
+    except ImportError:
+        logging.error("Error: numba not found. Install numba to use --numba.")
+        sys.exit(1)
+    threshold_pack_kernel = njit(cache=True)(swar_threshold_pack)
+
+def threshold_pack(pixels, dark_mode):
+    # Same layout as epd.getbuffer(): MSB first, rows padded to whole bytes, 1 = white
+    if threshold_pack_kernel is None:
+        white = pixels < THRESHOLD if dark_mode else pixels >= THRESHOLD
+        return bytearray(np.packbits(white, axis=1).tobytes())
+    height, width = pixels.shape
+    stride = (width + 7) // 8
+    if width % 8:
+        # Widen rows to whole words; the padding bits are masked off in the kernel
+        padded = np.zeros((height, stride * 8), dtype=np.uint8)
+        padded[:, :width] = pixels
+        pixels = padded
+    words = np.ascontiguousarray(pixels).view('<u8')
+    tail_mask = (0xFF << (stride * 8 - width)) & 0xFF
+    buffer = bytearray(stride * height)
+    threshold_pack_kernel(words, dark_mode, tail_mask, np.frombuffer(buffer, dtype=np.uint8))
+    return buffer
+
+def display_buffer(epd, buffer, state, full_refresh_every):
+    # Partial updates are fast and don't flash, but leave ghosting behind;
+    # a periodic full refresh clears it and resets the partial-mode base image.
+    frame_hash = hashlib.sha1(buffer).hexdigest()
+    if frame_hash == state.get("frame_hash"):
+        logging.info("Frame unchanged, skipping display update")
+        return
+    if state["updates"] % max(full_refresh_every, 1) == 0:
+        logging.info("Performing full refresh...")
+        if state.get("panel_mode") != "full":
+            # Wake the panel on first use, or take it out of partial mode
+            init_display(epd, state)
+        epd.displayPartBaseImage(buffer)
+    else:
+        epd.displayPartial(buffer)
+        state["panel_mode"] = "partial"
+    state["updates"] += 1
+    state["frame_hash"] = frame_hash
+
+def process_image(epd, api_key, dark_mode, dither, verbose, state, full_refresh_every, battery):
     headers = {
         "access-token": api_key,
-        "User-Agent": f"trmnl-display/{VERSION}"
+        "User-Agent": f"trmnl-display/{VERSION}",
+        "Width": str(epd.width),
+        "Height": str(epd.height)
     }
     logging.info("Fetching image from TRMNL API...")
     max_retries = 3
     for attempt in range(max_retries):
         try:
-            response = requests.get("https://usetrmnl.com/api/display", headers=headers, timeout=30)
+            response = session.get("https://usetrmnl.com/api/display", headers=headers, timeout=30)
             response.raise_for_status()
             logging.debug(f"API response status: {response.status_code}")
             break
@@ -90,7 +240,7 @@ def process_image(epd, api_key, dark_mode, verbose):
                 time.sleep(5)  # Reduced from 60s to 5s
             else:
                 logging.error("Max retries reached. Skipping this cycle.")
-                return
+                return 0
 
     try:
         data = response.json()
@@ -101,75 +251,94 @@ def process_image(epd, api_key, dark_mode, verbose):
         logging.info(f"API parsed: url={image_url}, filename={filename}, refresh={refresh_rate}")
     except (json.JSONDecodeError, KeyError) as e:
         logging.error(f"Error parsing JSON: {e}")
-        time.sleep(5)
-        return
+        return 5
 
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        file_path = os.path.join(tmp_dir, filename)
-        for attempt in range(max_retries):
-            try:
-                logging.info(f"Downloading image from {image_url}")
-                img_response = requests.get(image_url, timeout=30)
-                img_response.raise_for_status()
-                with open(file_path, 'wb') as f:
-                    f.write(img_response.content)
-                logging.debug(f"Image saved to {file_path}")
-                break
-            except requests.RequestException as e:
-                logging.error(f"Attempt {attempt + 1}/{max_retries} failed: {e}")
-                if attempt < max_retries - 1:
-                    time.sleep(5)
-                else:
-                    logging.error("Max retries reached for image download. Skipping.")
-                    return
-
-        if verbose:
-            logging.info(f"Reading image from {file_path}")
+    # The battery overlay needs the decoded image, which only a running process keeps
+    image_headers = {}
+    if image_url == state.get("image_url") and (battery is None or "image" in state):
+        if state.get("etag"):
+            image_headers["If-None-Match"] = state["etag"]
+        if state.get("last_modified"):
+            image_headers["If-Modified-Since"] = state["last_modified"]
 
+    for attempt in range(max_retries):
         try:
-            img = Image.open(file_path).convert('L')
-            img = img.resize((epd.width, epd.height), Image.NEAREST)
-            mono_img = Image.new('1', (epd.width, epd.height))
-            threshold = 128
-            for y in range(epd.height):
-                for x in range(epd.width):
-                    pixel = img.getpixel((x, y))
-                    if dark_mode:
-                        mono_img.putpixel((x, y), 255 if pixel < threshold else 0)
-                    else:
-                        mono_img.putpixel((x, y), 0 if pixel < threshold else 255)
-
-            mono_img.save("debug_buffer.png")
-            if verbose:
-                logging.info("Saved debug_buffer.png for inspection")
-
-            buffer = bytearray(epd.width * epd.height + 7 // 8)
-            for y in range(epd.height):
-                for x in range(epd.width):
-                    bit_pos = y * epd.width + x
-                    byte_pos = bit_pos // 8
-                    bit_offset = 7 - (bit_pos % 8)
-                    if mono_img.getpixel((x, y)) == 0:  # Black
-                        buffer[byte_pos] |= (1 << bit_offset)
-                    else:  # White
-                        buffer[byte_pos] &= ~(1 << bit_offset)
-
-            logging.info("Displaying image...")
-            epd.display(buffer)
+            logging.info(f"Downloading image from {image_url}")
+            img_response = session.get(image_url, headers=image_headers, timeout=30)
+            img_response.raise_for_status()
+            logging.debug(f"Image response status: {img_response.status_code}")
+            break
+        except requests.RequestException as e:
+            logging.error(f"Attempt {attempt + 1}/{max_retries} failed: {e}")
+            if attempt < max_retries - 1:
+                time.sleep(5)
+            else:
+                logging.error("Max retries reached for image download. Skipping.")
+                return 0
+
+    # An e-paper refresh is the slowest and most power-hungry step, so skip it
+    # whenever the server reports, or the bytes show, that nothing changed.
+    # With the battery overlay the cached image is redrawn instead, and
+    # display_buffer() skips the refresh if the readout is also unchanged.
+    if img_response.status_code == 304:
+        image_hash = state["image_hash"]
+    else:
+        image_hash = hashlib.sha1(img_response.content).hexdigest()
+    unchanged = image_hash == state.get("image_hash")
+    if unchanged and battery is None:
+        logging.info("Image unchanged, skipping display update")
+        return max(refresh_rate, 1)
+
+    try:
+        if unchanged and "image" in state:
+            img = state["image"]
+        else:
+            logging.debug(f"Downloaded {len(img_response.content)} bytes")
             if verbose:
-#                 logging.info("Image displayed on Waveshare 7.5\" e-ink display")
-                 logging.info("Image displayed on Waveshare 2.13\" e-ink display")
-            time.sleep(max(refresh_rate, 1))
-        except Exception as e:
-            logging.error(f"Error displaying image: {e}")
-            time.sleep(5)
+                logging.info(f"Decoding {filename}")
+            img = Image.open(BytesIO(img_response.content)).convert('L')
+            if img.size != (epd.width, epd.height):
+                img = img.resize((epd.width, epd.height), Image.NEAREST)
+
+        frame = draw_battery(img, battery) if battery is not None else img
+        if dither:
+            if dark_mode:
+                frame = ImageOps.invert(frame)
+            buffer = bytearray(frame.convert('1', dither=Image.FLOYDSTEINBERG).tobytes())
+        else:
+            buffer = threshold_pack(np.asarray(frame), dark_mode)
+
+        if verbose:
+            Image.frombytes('1', (epd.width, epd.height), bytes(buffer)).save("debug_buffer.png")
+            logging.info("Saved debug_buffer.png for inspection")
+
+        logging.info("Displaying image...")
+        display_buffer(epd, buffer, state, full_refresh_every)
+        if not unchanged:
+            state["image_url"] = image_url
+            state["etag"] = img_response.headers.get("ETag")
+            state["last_modified"] = img_response.headers.get("Last-Modified")
+            state["image_hash"] = image_hash
+            state["image"] = img
+        if verbose:
+#             logging.info("Image displayed on Waveshare 7.5\" e-ink display")
+             logging.info("Image displayed on Waveshare 2.13\" e-ink display")
+        return max(refresh_rate, 1)
+    except Exception as e:
+        logging.error(f"Error displaying image: {e}")
+        return 5
 
 def main():
     parser = argparse.ArgumentParser(description="TRMNL e-ink display client")
     parser.add_argument("-d", "--dark-mode", action="store_true", help="Enable dark mode (invert monochrome images)")
+    parser.add_argument("--dither", action="store_true", help="Floyd-Steinberg dither grayscale images instead of thresholding")
     parser.add_argument("-v", "--version", action="store_true", help="Show version information")
     parser.add_argument("--verbose", action="store_true", help="Enable verbose output")
     parser.add_argument("-q", "--quiet", action="store_true", help="Quiet mode (disable verbose output)")
+    parser.add_argument("--numba", action="store_true", help="Threshold and pack frames with a Numba-compiled kernel (requires numba)")
+    parser.add_argument("--with-battery", action="store_true", help="Overlay UPS-Lite battery voltage and charge in the top-right corner")
+    parser.add_argument("--oneshot", action="store_true", help="Fetch and display one image, then exit (for use with a systemd timer)")
+    parser.add_argument("--full-refresh-every", type=int, default=FULL_REFRESH_EVERY, help=f"Partial updates between full refreshes (default: {FULL_REFRESH_EVERY}, 1 disables partial updates)")
     args = parser.parse_args()
 
     if args.version:
@@ -180,19 +349,54 @@ def main():
     logging.basicConfig(level=log_level, format="%(message)s")
     logging.getLogger().setLevel(log_level)
 
+    if args.oneshot:
+        state = load_state({"dark_mode": args.dark_mode, "dither": args.dither, "battery": args.with_battery})
+        # The timer may fire more often than the server's refresh_rate; leave
+        # the network and panel alone until the next refresh is due
+        wait = state.get("next_update", 0) - time.time()
+        if wait > state.get("refresh_delay", 0) + ONESHOT_SLACK:
+            # Further out than any refresh_rate we saved; the clock must have jumped (no RTC)
+            logging.warning(f"Ignoring saved next refresh {wait:.0f}s in the future")
+        elif wait > ONESHOT_SLACK:
+            logging.info("Next refresh not due yet, exiting")
+            return
+    else:
+        state = {"updates": 0}
+
     api_key = get_api_key()
-    epd = init_display()
+    if args.numba:
+        enable_numba()
+    battery = init_battery() if args.with_battery else None
+    # Only the driver object for now; display_buffer() wakes the panel when
+    # there is something to draw, so unchanged oneshot runs never touch it
+    epd = epd2in13_V4.EPD()
+
+    # Turn systemd's SIGTERM into SystemExit so the finally block puts the panel to sleep
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
     try:
+        if args.oneshot:
+            # The panel keeps the previous image, so skip the clear and test pattern
+            started = time.time()
+            delay = process_image(epd, api_key, args.dark_mode, args.dither, args.verbose and not args.quiet, state, args.full_refresh_every, battery)
+            state["next_update"] = started + delay
+            state["refresh_delay"] = delay
+            save_state(state)
+            return
+        init_display(epd, state)
         clear_display(epd)
         test_display(epd)
         while True:
-            process_image(epd, api_key, args.dark_mode, args.verbose and not args.quiet)
+            delay = process_image(epd, api_key, args.dark_mode, args.dither, args.verbose and not args.quiet, state, args.full_refresh_every, battery)
+            time.sleep(delay)
+    except KeyboardInterrupt:
+        logging.info("Interrupted, shutting down...")
     finally:
-        epd.sleep()
-#         logging.info("Waveshare 7.5\" e-ink display put to sleep")
-        logging.info("Waveshare 2.13\" e-ink display put to sleep")
-        epd.epdconfig.module_exit()
+        if state.get("panel_mode") is not None:
+            epd.sleep()
+#             logging.info("Waveshare 7.5\" e-ink display put to sleep")
+            logging.info("Waveshare 2.13\" e-ink display put to sleep")
+            epd.epdconfig.module_exit()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file